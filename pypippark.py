@@ -1,145 +1,927 @@
 #!/usr/bin/env python3
 import os
+import pwd
 import sys
+import stat
 import subprocess
-import argparse
-import getpass
+import atexit
+import contextlib
+import functools
+import glob
+import hashlib
+import json
+import re
+import shutil
+import tempfile
+import threading
+import time
 
 # ─── CONFIG ────────────────────────────────────────────────────────────────
 VENV_PATH = "/usr/local/bin/pypippark-dep"
+VENV_BIN = f"{VENV_PATH}/bin"
+VENV_PY = f"{VENV_BIN}/python3"
+VENV_PIP = f"{VENV_BIN}/pip"
+PY_TAG = f"{sys.version_info.major}.{sys.version_info.minor}"  # caches are per interpreter version
+VENV_SITE = f"{VENV_PATH}/lib/python{PY_TAG}/site-packages"
+VENV_READY = f"{VENV_PATH}/.pypippark-ready"  # written once the venv is set up
 SYSTEM_PY = sys.executable  # e.g. /usr/bin/python3
 LOG_PREFIX = "[pypippark] "  # Unified log prefix
+PARALLEL = os.environ.get("PYPIPPARK_PARALLEL", "")  # worker count for parallel pip jobs
+DEFAULT_WORKERS = 4
+HOME = os.environ.get("HOME") or os.path.expanduser("~")
+CACHE_DIR = f"{HOME}/.cache/pypippark"
+WHEEL_DIR = f"{CACHE_DIR}/wheels/{PY_TAG}"  # pip wheel used to seed new venvs
+PIP_WHEEL_GLOB = f"{WHEEL_DIR}/pip-*.whl"
+PIP_CACHE_DIR = f"{CACHE_DIR}/pip"  # pip's HTTP/wheel cache, kept across runs
+TEMPLATE_DIR = f"{CACHE_DIR}/template-{PY_TAG}"  # pristine venv cloned into VENV_PATH
+TEMPLATE_MARKER = ".pypippark-template"  # written once the template is complete
+TEMPLATE_READY = f"{TEMPLATE_DIR}/{TEMPLATE_MARKER}"
+SATISFIED_DIR = f"{CACHE_DIR}/installed"  # markers for already-installed requests
+STATE_FILE = f"{CACHE_DIR}/state.json"  # facts about the current venv, e.g. its pip version
+PIP_UPGRADE_STAMP = f"{CACHE_DIR}/pip_upgrade.ts"  # last successful pip self-upgrade
+CACHE_TTL = 24 * 60 * 60  # seconds a stamp, install marker or cached state stays valid
 # ──────────────────────────────────────────────────────────────────────────
 
 
-def log(msg, level="INFO"):
-    """ Unified logging function for all messages. """
-    levels = {
-        "INFO": "ℹ️",
-        "SUCCESS": "✅",
-        "WARNING": "⚠️",
-        "ERROR": "❌"
-    }
-    emoji = levels.get(level, "❔")
-    print(f"{LOG_PREFIX}{emoji} {msg}")
-
+LOG_LEVELS = {
+    "INFO": "ℹ️",
+    "SUCCESS": "✅",
+    "WARNING": "⚠️",
+    "ERROR": "❌"
+}
+LOG_BUFFER = []
+QUIET = False  # --json: stdout carries only the summary record, logs go to stderr
+
+
+def flush_log():
+    """ Write all buffered log lines to stdout (stderr when QUIET) in one go. """
+    if LOG_BUFFER:
+        stream = sys.stderr if QUIET else sys.stdout
+        stream.writelines(LOG_BUFFER)
+        stream.flush()
+        LOG_BUFFER.clear()
+
+
+atexit.register(flush_log)
+
+
+def log(msg, level="INFO", flush=False):
+    """ Unified logging function for all messages.
+
+    Lines are buffered until exit; pass flush=True before handing the
+    terminal to pip or a script so the output stays in order.
+    """
+    emoji = LOG_LEVELS.get(level, "❔")
+    LOG_BUFFER.append(f"{LOG_PREFIX}{emoji} {msg}\n")
+    if flush:
+        flush_log()
+
+
+@functools.lru_cache(maxsize=8)
+def resolve_exe(exe):
+    """ Path of `exe`, searching PATH once per bare command name. """
+    return exe if os.sep in exe else (shutil.which(exe) or exe)
+
+
+def spawn(argv, env=None):
+    """ subprocess.run(argv, env=env, check=True) via posix_spawn, without forking this process.
+
+    When QUIET the child's stdout goes to /dev/null, like stdout=DEVNULL.
+    """
+    quiet = [(os.POSIX_SPAWN_OPEN, 1, os.devnull, os.O_WRONLY, 0)] if QUIET else ()
+    pid = os.posix_spawn(resolve_exe(argv[0]), argv, os.environ if env is None else env,
+                         file_actions=quiet)
+    _, status = os.waitpid(pid, 0)
+    rc = os.waitstatus_to_exitcode(status)
+    if rc:
+        raise subprocess.CalledProcessError(rc, argv)
+
+
+def stat_or_none(path):
+    """ os.stat() that returns None instead of raising for a missing path. """
+    try:
+        return os.stat(path)
+    except FileNotFoundError:
+        return None
+
+
+def chown_tree(path, uid, gid):
+    """ Recursively chown `path` in-process; symlinks are changed, not followed. """
+    def walk(top):
+        with os.scandir(top) as it:
+            for entry in it:
+                os.chown(entry.path, uid, gid, follow_symlinks=False)
+                if entry.is_dir(follow_symlinks=False):
+                    walk(entry.path)
+
+    os.chown(path, uid, gid, follow_symlinks=False)
+    tops = []
+    with os.scandir(path) as it:
+        for entry in it:
+            os.chown(entry.path, uid, gid, follow_symlinks=False)
+            if entry.is_dir(follow_symlinks=False):
+                tops.append(entry.path)
+    # The chown syscalls release the GIL, so bin/, lib/, ... can go in parallel
+    from concurrent.futures import ThreadPoolExecutor  # rarely needed, slow to import
+    with ThreadPoolExecutor(max_workers=max(1, len(tops))) as ex:
+        list(ex.map(walk, tops))
+
+
+def wheel_version(path):
+    """ Numeric version tuple from a wheel's file name, e.g. pip-24.0-py3-none-any.whl → (24, 0). """
+    return tuple(int(n) for n in re.findall(r"\d+", os.path.basename(path).split("-")[1]))
+
+
+def staged_pip_wheel():
+    """ Path of the newest pip wheel for this interpreter, cached or bundled with ensurepip.
+
+    A bundled wheel newer than the cached one replaces it, so an interpreter
+    upgrade never bootstraps from a pip too old to run on it.
+    """
+    import ensurepip  # only needed on the cold path
+    bundled = glob.glob(os.path.join(os.path.dirname(ensurepip.__file__), "_bundled", "pip-*.whl"))
+    cached = glob.glob(PIP_WHEEL_GLOB)
+    newest = max(cached + bundled, key=wheel_version, default=None)
+    if newest is None or newest in cached:
+        return newest
+    try:
+        os.makedirs(WHEEL_DIR, exist_ok=True)
+        for old in cached:
+            os.remove(old)
+        return shutil.copy2(newest, WHEEL_DIR)
+    except OSError:
+        return newest
+
+
+def build_venv(path):
+    """ Create a venv at `path` with pip in it, avoiding ensurepip.
+
+    virtualenv, when importable, seeds pip by copying it from its app-data
+    cache; symlinks would tie the system-wide venv to the caller's home.
+    Otherwise the stdlib venv is created without pip and pip is installed
+    from the cached wheel.
+    """
+    # Templates and staging copies are built elsewhere; name the prompt
+    # after the venv they become
+    prompt = ["--prompt", os.path.basename(VENV_PATH)]
+    try:
+        from virtualenv import cli_run  # optional, and heavy to import
+    except ImportError:
+        cli_run = None
+    if cli_run is not None:
+        cli_run([path, "--quiet", "--no-periodic-update", "--no-download"] + prompt)
+        return
 
-def ensure_venv(path):
-    """ Ensure the venv exists and fix permissions if needed. """
-    if not os.path.isdir(path):
-        log(f"Creating virtualenv at {path!r}", "INFO")
-        subprocess.run([SYSTEM_PY, "-m", "venv", path], check=True)
+    wheel = staged_pip_wheel()
+    if wheel is None:
+        spawn([SYSTEM_PY, "-m", "venv"] + prompt + [path])
+        return
+    spawn([SYSTEM_PY, "-m", "venv", "--without-pip"] + prompt + [path])
+    bootstrap = ("import runpy, sys; sys.path.insert(0, sys.argv.pop(1)); "
+                 "runpy.run_module('pip', run_name='__main__', alter_sys=True)")
+    spawn([os.path.join(path, "bin", "python3"), "-I", "-c", bootstrap, wheel,
+           "install", "--quiet", "--no-index", "--find-links", os.path.dirname(wheel), "pip"])
+
+
+def clone_tree(src, dst):
+    """ Copy a directory tree, hardlinking files where the filesystem allows it. """
+    def link_or_copy(s, d):
+        try:
+            os.link(s, d)
+        except OSError:  # e.g. EXDEV across filesystems
+            shutil.copy2(s, d)
+
+    shutil.copytree(src, dst, symlinks=True, copy_function=link_or_copy,
+                    ignore=shutil.ignore_patterns(TEMPLATE_MARKER), dirs_exist_ok=True)
+
+
+def relocate_venv(tree, old, new):
+    """ Rewrite path `old` to `new` in pyvenv.cfg and the bin/ scripts of the venv at `tree`. """
+    old, new = os.fsencode(old), os.fsencode(new)
+    with os.scandir(os.path.join(tree, "bin")) as it:
+        scripts = [e.path for e in it if e.is_file(follow_symlinks=False)]
+    for path in [os.path.join(tree, "pyvenv.cfg")] + scripts:
+        with open(path, "rb") as f:
+            data = f.read()
+        if old not in data:
+            continue
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+        os.unlink(path)  # break the hardlink so the template stays intact
+        with open(path, "wb") as f:
+            f.write(data.replace(old, new))
+        os.chmod(path, mode)
+
+
+def create_venv():
+    """ Create the venv by cloning a cached template, building it on first use.
+
+    The venv is assembled and relocated in a sibling directory, then
+    renamed into place, so VENV_PATH never holds a partial venv.
+    """
+    staging = f"{VENV_PATH}.{os.getpid()}.tmp"
+    shutil.rmtree(staging, ignore_errors=True)
+    try:
+        src = TEMPLATE_DIR
+        if not os.path.exists(TEMPLATE_READY):
+            try:
+                shutil.rmtree(TEMPLATE_DIR, ignore_errors=True)
+                build_venv(TEMPLATE_DIR)
+                open(TEMPLATE_READY, "w").close()
+            except (OSError, subprocess.CalledProcessError):
+                src = staging  # no usable cache directory, build directly
+                build_venv(staging)
+        if src == TEMPLATE_DIR:
+            clone_tree(TEMPLATE_DIR, staging)
+        relocate_venv(staging, src, VENV_PATH)
+        try:
+            os.rename(staging, VENV_PATH)
+        except OSError:
+            if not os.path.exists(f"{VENV_PATH}/pyvenv.cfg"):
+                raise
+            # a concurrent run put its venv in place first
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+
+def ensure_venv(pkgs=()):
+    """ Ensure the venv exists and fix permissions if needed.
+
+    When the venv has to be built, `pkgs` are fetched meanwhile.
+    """
+    if os.path.exists(VENV_READY):
+        return VENV_PY, VENV_PIP
+
+    # create_venv only ever renames a complete venv into place, so one
+    # directory read tells a real venv from a missing one
+    try:
+        with os.scandir(VENV_PATH) as it:
+            entries = {entry.name for entry in it}
+    except FileNotFoundError:
+        entries = set()
+    existed = "pyvenv.cfg" in entries
+    if not existed:
+        log(f"Creating virtualenv at {VENV_PATH!r}", "INFO", flush=True)
+        if entries:
+            shutil.rmtree(VENV_PATH)  # debris of an interrupted build; the rename needs the path
+        if pkgs:
+            start_prefetch(list(pkgs))  # overlap the network fetch with the build
+        create_venv()
 
     # Fix ownership if running as root
-    if not os.access(path, os.W_OK) and os.geteuid() == 0:
-        user = getpass.getuser()
-        log(f"Adjusting ownership of {path!r} → {user}:{user}", "WARNING")
-        subprocess.run(["chown", "-R", f"{user}:{user}", path], check=True)
+    if existed and not os.stat(VENV_PATH).st_mode & stat.S_IWUSR and os.geteuid() == 0:
+        # Under sudo, hand the venv to the invoking user rather than root
+        user = os.environ.get("SUDO_USER") or pwd.getpwuid(os.getuid()).pw_name
+        pw = pwd.getpwnam(user)
+        log(f"Adjusting ownership of {VENV_PATH!r} → {user}", "WARNING")
+        chown_tree(VENV_PATH, pw.pw_uid, pw.pw_gid)
+
+    # Mark the venv as known-good so later runs skip the checks above
+    try:
+        open(VENV_READY, "w").close()
+    except OSError:
+        pass
 
-    return os.path.join(path, "bin", "python3"), os.path.join(path, "bin", "pip")
+    return VENV_PY, VENV_PIP
 
 
-def activate_env(path):
-    """ Return a copy of os.environ “inside” the venv. """
+VENV_ENV = None  # environ computed once by activate_env
+
+
+def activate_env():
+    """ Return a copy of os.environ “inside” the venv (built once, do not mutate). """
+    global VENV_ENV
+    if VENV_ENV is not None:
+        return VENV_ENV
     env = os.environ.copy()
-    env["VIRTUAL_ENV"] = path
-    env["PATH"] = os.path.join(path, "bin") + os.pathsep + env.get("PATH", "")
+    env["VIRTUAL_ENV"] = VENV_PATH
+    env["PATH"] = f"{VENV_BIN}{os.pathsep}{env.get('PATH', '')}"
     env.pop("PYTHONHOME", None)
+    # Skip pip's self-update check (an extra HTTP round-trip) and nag output
+    env["PIP_DISABLE_PIP_VERSION_CHECK"] = "1"
+    env["PIP_NO_PYTHON_VERSION_WARNING"] = "1"
+    # Reuse downloads across runs, take wheels over sdists that need a build,
+    # and never stop to prompt
+    env.setdefault("PIP_CACHE_DIR", PIP_CACHE_DIR)
+    env["PIP_PREFER_BINARY"] = "1"
+    env["PIP_NO_INPUT"] = "1"
+    VENV_ENV = env
     return env
 
 
-def cmd_install(pkgs):
-    """ Install packages into the venv. """
-    _, pip = ensure_venv(VENV_PATH)
-    cmd = [pip, "install"] + pkgs
-    log(f"Installing {', '.join(pkgs)}...", "INFO")
-    subprocess.run(cmd, env=activate_env(VENV_PATH), check=True)
+def pip_inproc(argv):
+    """ Run the venv's pip inside this interpreter; None if it cannot be imported.
+
+    pip still sees this interpreter's sys.prefix, scheme and PEP 668
+    marker, so this is only fit for read-only commands given an explicit
+    --path; anything that modifies the venv must run the venv's own pip.
+    """
+    sys.path.insert(0, VENV_SITE)
+    try:
+        from pip._internal.cli.main import main as pip_main
+    except ImportError:
+        sys.path.remove(VENV_SITE)
+        return None
+    if not QUIET:
+        return pip_main(argv)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        return pip_main(argv)
+
+
+def exec_pip(pip, argv, env):
+    """ Replace this process with pip; pending log lines are written first. """
+    flush_log()
+    os.execve(pip, [pip] + argv, env)
+
+
+def run_pip(pip, argv, env, final=False):
+    """ Run a pip command in-process, falling back to a subprocess.
+
+    With final=True nothing follows the command, so the fallback replaces
+    this process with pip instead of forking a child.
+    """
+    rc = pip_inproc(argv)
+    if rc is None and final and not QUIET:
+        exec_pip(pip, argv, env)
+    elif rc is None:
+        spawn([pip] + argv, env)
+    elif rc:
+        raise subprocess.CalledProcessError(rc, [pip] + argv)
+
+
+def parallel_workers(count, default=0):
+    """ Number of workers for `count` pip jobs (None: unknown); PYPIPPARK_PARALLEL overrides `default`. """
+    if not PARALLEL:
+        workers = default
+    elif PARALLEL.isdigit():
+        workers = int(PARALLEL)
+    else:
+        workers = DEFAULT_WORKERS
+    return workers if count is None else min(workers, count)
+
+
+def download_parallel(pip, pkgs, dest, env, workers):
+    """ Download packages (and their deps) under `dest` with `workers` pip processes.
+
+    Each worker gets its own directory, returned in a list: pip trusts any
+    file already in --dest, so a shared one could hand it a wheel another
+    worker is still writing.
+    """
+    dirs = [os.path.join(dest, str(i)) for i in range(workers)]
+
+    def fetch(i):
+        # Concurrent progress bars only garble the terminal and cost a write per tick
+        cmd = [pip, "download", "--progress-bar", "off", "--dest", dirs[i]]
+        for batch in argv_batches(cmd, pkgs[i::workers], env):
+            spawn(cmd + batch, env)
+
+    from concurrent.futures import ThreadPoolExecutor  # see chown_tree
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        list(ex.map(fetch, range(workers)))
+    return dirs
+
+
+async def upgrade_outdated(pip, env, workers, with_pip=True):
+    """ Upgrade outdated packages, wheels in parallel and sdists one at a time.
+
+    pip itself, if outdated, goes first and alone so no other run imports
+    it mid-upgrade; with_pip=False leaves it untouched. Each run's output
+    is written in one piece as soon as it finishes, so workers never
+    interleave. Returns (name, returncode, stdout, stderr) for every run.
+
+    close_fds=False lets subprocess start pip with posix_spawn rather than
+    fork+exec; only descriptors explicitly marked inheritable (none here,
+    see PEP 446) leak into the child.
+    """
+    import asyncio  # only update needs it, and it is slow to import
+    lister = await asyncio.create_subprocess_exec(
+        pip, "list", "--outdated", "--format=json",
+        stdout=asyncio.subprocess.PIPE, env=env, close_fds=False  # exit status is not checked
+    )
+    out, _ = await lister.communicate()
+    try:
+        outdated = json.loads(out or b"[]")
+    except ValueError:
+        outdated = []
+    selfs = [p["name"] for p in outdated if canonical_name(p["name"]) == "pip"]
+    outdated = [p for p in outdated if canonical_name(p["name"]) != "pip"]
+    wheels = [p["name"] for p in outdated if p.get("latest_filetype") == "wheel"]
+    sdists = [p["name"] for p in outdated if p.get("latest_filetype") != "wheel"]
+    done = []
+
+    async def upgrade(queue):
+        while (name := await queue.get()) is not None:
+            proc = await asyncio.create_subprocess_exec(
+                pip, "install", "--upgrade", "--no-deps", name,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, env=env,
+                close_fds=False
+            )
+            out, err = await proc.communicate()
+            done.append((name, proc.returncode, out, err))
+            if not QUIET:
+                sys.stdout.buffer.write(out)
+                sys.stdout.flush()
+            sys.stderr.buffer.write(err)
+            if proc.returncode:
+                log(f"Failed to upgrade {name}", "ERROR", flush=True)
+            else:
+                log(f"Upgraded {name}", "SUCCESS", flush=True)
+
+    async def drain(names, count):
+        queue = asyncio.Queue()
+        for name in names + [None] * count:
+            queue.put_nowait(name)
+        await asyncio.gather(*(upgrade(queue) for _ in range(count)))
+
+    if with_pip:
+        await drain(selfs, 1)
+    # Wheels only unpack, so they can go side by side; sdists build serially
+    await drain(wheels, max(1, min(workers, len(wheels))))
+    await drain(sdists, 1)
+    return done
+
+
+def pip_version():
+    """ Version tuple of the pip installed in the venv, (0,) if unknown.
+
+    Remembered in STATE_FILE so repeat runs skip the site-packages scan.
+    The entry is tied to the pip package directory itself, which any
+    reinstall of pip replaces, whoever runs it.
+    """
+    pkg = stat_or_none(f"{VENV_SITE}/pip")
+    key = None if pkg is None else [pkg.st_ino, pkg.st_mtime_ns]
+    state = load_state()
+    if "pip_version" in state and state.get("pip_dir") == key:
+        return tuple(state["pip_version"])
+    import importlib.metadata  # slow to import; most runs never get here
+    version = (0,)
+    for dist in importlib.metadata.distributions(name="pip", path=[VENV_SITE]):
+        version = tuple(int(n) for n in re.findall(r"\d+", dist.version)[:3])
+        break
+    state.update(pip_version=version, pip_dir=key)
+    save_state(state)
+    return version
+
+
+def canonical_name(spec):
+    """ Normalised project name of a pip requirement spec (PEP 503). """
+    name = re.split(r"[\s\[<>=!~;@]", spec.strip(), maxsplit=1)[0]
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def dedup_specs(pkgs):
+    """ Drop blank and repeated specs, keeping order; `Foo_Bar>=1` repeats `foo-bar >= 1`. """
+    seen = {}
+    for spec in pkgs:
+        spec = spec.strip()
+        if not spec:
+            continue
+        name = canonical_name(spec)
+        rest = "".join(spec[len(re.match(r"[\w.-]*", spec).group()):].split())
+        seen.setdefault((name, rest), spec)
+    return list(seen.values())
+
+
+def request_specs(pkgs):
+    """ Order-independent, de-duplicated text form of a set of requirement specs. """
+    return "\n".join(sorted({spec.strip() for spec in pkgs}))
+
+
+def write_atomic(path, data):
+    """ Replace `path` with `data` so readers never see a partial file. """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def invalidate_caches():
+    """ Drop install markers and venv state after the venv contents changed. """
+    try:
+        os.remove(STATE_FILE)
+    except FileNotFoundError:
+        pass
+    shutil.rmtree(SATISFIED_DIR, ignore_errors=True)
+
+
+def request_digest(pkgs):
+    """ BLAKE2 digest of the normalised set of requirement specs. """
+    return hashlib.blake2b(request_specs(pkgs).encode(), digest_size=16).hexdigest()
+
+
+def stamp_is_fresh(path):
+    """ True if the stamp file is younger than CACHE_TTL and than the current venv. """
+    st = stat_or_none(path)
+    if st is None or time.time() - st.st_mtime > CACHE_TTL:
+        return False
+    # A venv recreated since then has a newer ready marker
+    ready = stat_or_none(VENV_READY)
+    return ready is not None and st.st_mtime >= ready.st_mtime
+
+
+def touch_stamp(path):
+    """ Create or refresh a stamp file; failures only cost a cache miss. """
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, "w").close()
+    except OSError:
+        pass
+
+
+def load_state():
+    """ Cached facts about the current venv; {} once stale by stamp_is_fresh's rules. """
+    if not stamp_is_fresh(STATE_FILE):
+        return {}
+    try:
+        with open(STATE_FILE, "rb") as f:
+            return json.loads(f.read())
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(state):
+    """ Atomically write the venv state; failures only cost a cache miss. """
+    try:
+        write_atomic(STATE_FILE, json.dumps(state).encode())
+    except OSError:
+        pass
+
+
+def is_satisfied(pkgs):
+    """ True if the same request was installed recently and the venv is unchanged since.
+
+    Any install or uninstall, by any user or by the venv's pip directly,
+    adds or removes a dist-info and so bumps site-packages' mtime.
+    """
+    marker = f"{SATISFIED_DIR}/{request_digest(pkgs)}"
+    if not stamp_is_fresh(marker):
+        return False
+    site = stat_or_none(VENV_SITE)
+    return site is not None and os.stat(marker).st_mtime >= site.st_mtime
+
+
+def mark_satisfied(pkgs):
+    """ Remember that `pkgs` were installed successfully just now. """
+    touch_stamp(f"{SATISFIED_DIR}/{request_digest(pkgs)}")
+
+
+def argv_batches(cmd, items, env):
+    """ Split `items` into as few batches as possible so `cmd + batch` fits in ARG_MAX. """
+    def size(arg):
+        return len(os.fsencode(arg)) + 1 + 8  # bytes, NUL terminator, pointer
+
+    room = (os.sysconf("SC_ARG_MAX") - 4096
+            - sum(size(f"{k}={v}") for k, v in env.items()) - sum(size(a) for a in cmd))
+    batches, batch, used = [], [], 0
+    for item in items:
+        if batch and used + size(item) > room:
+            batches.append(batch)
+            batch, used = [], 0
+        batch.append(item)
+        used += size(item)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def requirement_class():
+    """ packaging's Requirement, from the system or the venv's vendored copy; None if absent. """
+    try:
+        from packaging.requirements import Requirement
+        return Requirement
+    except ImportError:
+        pass
+    sys.path.insert(0, VENV_SITE)
+    try:
+        from pip._vendor.packaging.requirements import Requirement
+        return Requirement
+    except ImportError:
+        return None
+    finally:
+        sys.path.remove(VENV_SITE)
+
+
+def installed_versions():
+    """ {canonical name: version} of every distribution in the venv. """
+    import importlib.metadata  # slow to import; see pip_version
+    versions = {}
+    for dist in importlib.metadata.distributions(path=[VENV_SITE]):
+        name = dist.metadata["Name"]
+        if name:
+            versions[canonical_name(name)] = dist.version
+    return versions
+
+
+def missing_specs(pkgs):
+    """ The specs in `pkgs` not known to be satisfied by the venv as it stands.
+
+    Anything that cannot be checked cheaply (URLs, extras, markers, or no
+    packaging available) counts as missing and is left to pip.
+    """
+    installed = installed_versions()
+    requirement = None
+    missing = []
+    for spec in pkgs:
+        version = installed.get(canonical_name(spec))
+        if version is None:
+            missing.append(spec)
+            continue
+        if re.fullmatch(r"[\w.-]+", spec):
+            continue  # bare name, any installed version will do
+        requirement = requirement or requirement_class()
+        try:
+            req = requirement(spec)
+        except (TypeError, ValueError):  # no packaging, or a spec it rejects
+            missing.append(spec)
+            continue
+        if req.url or req.extras or req.marker or not req.specifier.contains(version, prereleases=True):
+            missing.append(spec)
+    # Keep every constraint on a project that pip has to act on
+    names = {canonical_name(spec) for spec in missing}
+    return [spec for spec in pkgs if canonical_name(spec) in names]
+
+
+PREFETCH = None  # (process, download dir) of a running start_prefetch
+
+
+def start_prefetch(pkgs):
+    """ Fetch `pkgs` into pip's cache with the system pip, in the background.
+
+    The venv's pip then takes the files from the shared PIP_CACHE_DIR
+    instead of downloading them again. Best effort: if the system pip is
+    missing or fails, pip simply downloads later.
+    """
+    global PREFETCH
+    dest = tempfile.mkdtemp(prefix="pypippark-prefetch-")
+    cmd = [SYSTEM_PY, "-m", "pip", "download", "--quiet", "--progress-bar", "off",
+           "--dest", dest] + pkgs
+    try:
+        # close_fds=False keeps subprocess on its posix_spawn path (see upgrade_outdated)
+        proc = subprocess.Popen(cmd, env=activate_env(), stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL, close_fds=False)
+    except OSError:
+        shutil.rmtree(dest, ignore_errors=True)
+        return
+    PREFETCH = proc, dest
+    atexit.register(finish_prefetch, wait=False)  # never leave it running behind us
+
+
+def finish_prefetch(wait=True):
+    """ Wait for a running prefetch (kill it with wait=False) and remove its files. """
+    global PREFETCH
+    if PREFETCH is None:
+        return
+    proc, dest = PREFETCH
+    PREFETCH = None
+    if not wait:
+        proc.kill()
+    proc.wait()
+    shutil.rmtree(dest, ignore_errors=True)
+
+
+def cmd_install(pkgs, fast=False):
+    """ Install packages into the venv, in a single pip run whenever argv allows. """
+    pkgs = dedup_specs(pkgs)
+    _, pip = ensure_venv(pkgs)
+    env = activate_env()
+    if is_satisfied(pkgs):
+        log(f"Already satisfied: {', '.join(pkgs)}", "SUCCESS")
+        return
+    # Only hand pip what the venv does not already provide
+    requested, pkgs = pkgs, missing_specs(pkgs)
+    if not pkgs:
+        log(f"All requested packages already installed: {', '.join(requested)}", "SUCCESS")
+        mark_satisfied(requested)
+        return
+    log(f"Installing {', '.join(pkgs)}...", "INFO", flush=True)
+    touches_pip = "pip" in map(canonical_name, pkgs)
+
+    # --fast: build sdists against what is already in the venv instead of
+    # provisioning a fresh isolated build environment for each
+    pip_opts = ["--no-build-isolation"] if fast else []
+    finish_prefetch()  # let pip find everything in its cache
+    workers = parallel_workers(len(pkgs))
+    with tempfile.TemporaryDirectory(prefix="pypippark-") as tmp:
+        cmd = [pip, "install"] + pip_opts
+        version = pip_version()
+        if workers:
+            # Fetch concurrently, then install offline from the staged files
+            wheels = os.path.join(tmp, "wheels")
+            log(f"Downloading with {workers} workers...", "INFO", flush=True)
+            cmd.append("--no-index")
+            for found in download_parallel(pip, pkgs, wheels, env, workers):
+                cmd += ["--find-links", found]
+        elif (21, 2) <= version < (23, 2):
+            # Resolve from wheel metadata via range requests; pip 23.2+
+            # uses PEP 658 metadata files for this on its own
+            cmd += ["--use-feature=fast-deps"]
+        # Only split when the list would overflow ARG_MAX; each split costs
+        # an extra pip start-up and resolver run
+        for batch in argv_batches(cmd, pkgs, env):
+            spawn(cmd + batch, env)
+    if touches_pip:
+        save_state({})  # the cached pip version is gone stale
+    mark_satisfied(requested)
+
     log(f"Installed {', '.join(pkgs)} successfully!", "SUCCESS")
 
 
 def cmd_list():
     """ List installed packages in the venv. """
-    _, pip = ensure_venv(VENV_PATH)
-    log("Listing installed packages...", "INFO")
-    subprocess.run([pip, "list"], env=activate_env(VENV_PATH), check=True)
+    _, pip = ensure_venv()
+    log("Listing installed packages...", "INFO", flush=True)
+    run_pip(pip, ["list", "--path", VENV_SITE], activate_env(), final=True)
 
 
 def cmd_remove(pkgs):
     """ Uninstall packages from the venv. """
-    _, pip = ensure_venv(VENV_PATH)
-    cmd = [pip, "uninstall", "-y"] + pkgs
-    log(f"Removing {', '.join(pkgs)}...", "WARNING")
-    subprocess.run(cmd, env=activate_env(VENV_PATH), check=True)
+    pkgs = dedup_specs(pkgs)
+    _, pip = ensure_venv()
+    log(f"Removing {', '.join(pkgs)}...", "WARNING", flush=True)
+    invalidate_caches()
+    # The venv's own pip: an in-process one would act on the host environment
+    spawn([pip, "uninstall", "-y"] + pkgs, activate_env())
     log(f"Removed {', '.join(pkgs)} successfully!", "SUCCESS")
 
 
 def cmd_update():
-    """ Update pip itself, then all other outdated packages in the venv. """
-    _, pip = ensure_venv(VENV_PATH)
-    env = activate_env(VENV_PATH)
-
-    # 1) Upgrade pip
-    log("Upgrading pip...", "INFO")
-    subprocess.run([pip, "install", "--upgrade", "pip"], env=env, check=True)
-
-    # 2) List outdated packages in freeze format
-    log("Checking for outdated packages…", "INFO")
-    proc = subprocess.run(
-        [pip, "list", "--outdated", "--format=freeze"],
-        capture_output=True, text=True, env=env  # no check=True
-    )
-
-    # 3) Parse the output
-    out = proc.stdout.strip()
-    if not out:
+    """ Update pip itself, then all other outdated packages; returns their names. """
+    _, pip = ensure_venv()
+    env = activate_env()
+
+    # 1) One listing finds outdated packages, pip included; pip is
+    #    skipped if it was upgraded within CACHE_TTL
+    with_pip = not stamp_is_fresh(PIP_UPGRADE_STAMP)
+    log("Checking for outdated packages…", "INFO", flush=True)
+
+    # 2) Upgrade every outdated package with --no-deps, so parallel runs
+    #    never install the same dependency at once
+    workers = max(1, parallel_workers(None, DEFAULT_WORKERS))
+    import asyncio  # see upgrade_outdated
+    done = asyncio.run(upgrade_outdated(pip, env, workers, with_pip))
+    if any(name == "pip" and not rc for name, rc, *_ in done):
+        touch_stamp(PIP_UPGRADE_STAMP)
+    if not done:
         log("All packages are already up-to-date.", "SUCCESS")
-        return
-
-    pkgs = [line.split("==")[0] for line in out.splitlines() if line]
-    log(f"Upgrading: {', '.join(pkgs)}", "INFO")
-
-    # 4) Batch-upgrade the outdated packages
-    subprocess.run([pip, "install", "--upgrade"] + pkgs, env=env, check=True)
+        return []
+
+    # 3) One resolving run adds whatever dependencies the new releases
+    #    introduced, and reports any conflicts between them
+    failed = [name for name, rc, *_ in done if rc]
+    upgraded = [name for name, rc, *_ in done if not rc]
+    if upgraded:
+        log("Installing new dependencies…", "INFO", flush=True)
+        cmd = [pip, "install"]
+        try:
+            for batch in argv_batches(cmd, upgraded, env):
+                spawn(cmd + batch, env)
+        except subprocess.CalledProcessError:
+            failed.append("dependencies")
+    invalidate_caches()
+    if failed:
+        log(f"Failed to upgrade: {', '.join(failed)}", "ERROR")
+        sys.exit(1)
     log("All packages updated successfully!", "SUCCESS")
-
-
+    return [name for name, *_ in done]
 
 
 def cmd_run(script, script_args):
-    """ Run a Python script inside the venv. """
-    py, _ = ensure_venv(VENV_PATH)
-    if not os.path.isfile(script):
-        log(f"Script not found: {script}", "ERROR")
+    """ Run a Python script inside the venv by replacing this process.
+
+    The venv's interpreter reports a missing or unreadable script itself,
+    so there is no separate pre-check that could race with the exec.
+    """
+    py, _ = ensure_venv()
+    log(f"Running {script!r}...", "INFO", flush=True)
+    try:
+        os.execve(py, [py, script] + script_args, activate_env())
+    except OSError as e:
+        log(f"Cannot start {py!r}: {e.strerror}", "ERROR")
         sys.exit(1)
-    log(f"Running {script!r}...", "INFO")
-    subprocess.run([py, script] + script_args, env=activate_env(VENV_PATH), check=True)
-    log(f"Finished running {script!r}", "SUCCESS")
+
+
+FAST_COMMANDS = {
+    "install": cmd_install,
+    "list": lambda args: cmd_list(),
+    "remove": cmd_remove,
+    "update": lambda args: cmd_update(),
+    "run": lambda args: cmd_run(args[0], args[1:]),
+}
+
+
+def fast_dispatch(argv):
+    """ Route plain invocations without argparse; False when it is needed. """
+    if not argv or argv[0] not in FAST_COMMANDS:
+        return False
+    cmd, rest = argv[0], argv[1:]
+    if cmd == "run":
+        plain = rest and not rest[0].startswith("-")  # script args pass through
+    elif cmd in ("list", "update"):
+        plain = not rest
+    else:
+        plain = rest and not any(a.startswith("-") for a in rest)
+    if not plain:
+        return False
+    FAST_COMMANDS[cmd](rest)
+    return True
+
+
+def read_specs(stream):
+    """ Requirement specs from `stream` in requirements-file form, one per line.
+
+    Continuation lines are joined; comments and trailing per-line options
+    such as --hash are dropped; lines holding only options (-r, --index-url, ...)
+    are skipped with a warning.
+    """
+    specs = []
+    for line in re.sub(r"\\\n", " ", stream.read()).splitlines():
+        line = re.sub(r"(^|\s)#.*", "", line).strip()
+        if line.startswith("-"):
+            log(f"Ignoring pip option line on stdin: {line}", "WARNING")
+            continue
+        line = re.split(r"\s--?[A-Za-z]", line, maxsplit=1)[0].strip()
+        if line:
+            specs.append(line)
+    return specs
+
+
+def json_summary(cmd, pkgs, action):
+    """ Run `action` quietly and print one JSON record; returns the exit code.
+
+    `packages` is what the command returned, else the packages it was given.
+    """
+    global QUIET
+    QUIET = True
+    rc, result = 0, None
+    try:
+        result = action()
+    except subprocess.CalledProcessError as e:
+        rc = e.returncode
+    except SystemExit as e:
+        rc = e.code if isinstance(e.code, int) else 1
+    except OSError as e:  # e.g. the venv's pip cannot be started
+        log(f"{e.filename or cmd}: {e.strerror}", "ERROR")
+        rc = 1
+    record = {"command": cmd, "install_dir": VENV_PATH,
+              "packages": pkgs if result is None else result, "returncode": rc}
+    flush_log()
+    sys.stdout.write(json.dumps(record) + "\n")
+    return rc
 
 
 def main():
+    # Common invocations skip building the parser; help, flags and errors
+    # still go through argparse
+    if fast_dispatch(sys.argv[1:]):
+        return
+
+    import argparse
     p = argparse.ArgumentParser(
         prog="pypippark",
         description="Manage a single, system‐wide venv at /usr/local/bin/pypippark-dep"
     )
     subs = p.add_subparsers(dest="cmd", required=True)
+    summary = argparse.ArgumentParser(add_help=False)
+    summary.add_argument("--json", action="store_true",
+                         help="print a single JSON summary record instead of pip's output")
 
-    ins = subs.add_parser("install", help="Install packages")
-    ins.add_argument("pkgs", nargs="+", help="package names (pip syntax)")
+    ins = subs.add_parser("install", parents=[summary], help="Install packages")
+    ins.add_argument("pkgs", nargs="*",
+                     help="package names (pip syntax); none or '-' reads them from stdin")
+    ins.add_argument("--fast", action="store_true",
+                     help="build sdists without build isolation (needs their build "
+                          "dependencies already installed)")
 
     subs.add_parser("list", help="List installed packages")
 
-    rem = subs.add_parser("remove", help="Remove packages")
+    rem = subs.add_parser("remove", parents=[summary], help="Remove packages")
     rem.add_argument("pkgs", nargs="+", help="package names to remove")
 
-    subs.add_parser("update", help="Update all packages")
+    subs.add_parser("update", parents=[summary], help="Update all packages")
 
     run = subs.add_parser("run", help="Run a Python script inside the venv")
     run.add_argument("script", help="path to the .py file")
     run.add_argument("args", nargs=argparse.REMAINDER, help="arguments to pass to the script")
 
     args = p.parse_args()
-    if args.cmd == "install":
-        cmd_install(args.pkgs)
+    if args.cmd == "install" and args.pkgs in ([], ["-"]):
+        if not args.pkgs and sys.stdin.isatty():
+            ins.error("no packages given (pass them as arguments or on stdin)")
+        # Any number of specs; argv_batches keeps each pip run under ARG_MAX
+        args.pkgs = read_specs(sys.stdin)
+        if not args.pkgs:
+            ins.error("no packages on stdin")
+    if getattr(args, "json", False):
+        actions = {
+            "install": lambda: cmd_install(args.pkgs, args.fast),
+            "remove": lambda: cmd_remove(args.pkgs),
+            "update": cmd_update,
+        }
+        rc = json_summary(args.cmd, getattr(args, "pkgs", []), actions[args.cmd])
+        if rc:
+            sys.exit(rc)
+    elif args.cmd == "install":
+        cmd_install(args.pkgs, args.fast)
     elif args.cmd == "list":
         cmd_list()
     elif args.cmd == "remove":